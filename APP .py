@@ -4,22 +4,31 @@
 # ============================================
 
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from streamlit.runtime.scriptrunner.script_run_context import SCRIPT_RUN_CONTEXT_ATTR_NAME
 import pandas as pd
+import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
 from datetime import datetime, timedelta
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import logging
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2 import pool
+from psycopg2.extras import RealDictCursor, execute_values
 import qrcode
 from io import BytesIO
-import base64
 from reportlab.lib.pagesizes import letter, A4
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import inch
 from reportlab.lib import colors
 import hashlib
-import json
+import orjson
+
+logger = logging.getLogger(__name__)
 
 # ============================================
 # CONFIGURACIÓN DE LA PÁGINA
@@ -85,69 +94,194 @@ st.markdown("""
 class DatabaseConnection:
     """Clase para manejar la conexión con Supabase PostgreSQL"""
     
-    def __init__(self):
+    def __init__(self, minconn=1, maxconn=10):
         # IMPORTANTE: Reemplaza estos valores con tus credenciales de Supabase
         self.config = {
             'host': 'db.xxxxxxxxxx.supabase.co',  # Tu host de Supabase
             'database': 'postgres',
             'user': 'postgres',
             'password': 'tu_password_supabase',  # Tu contraseña
-            'port': '5432'
+            'port': '5432',
+            'sslmode': 'require',
+            'gssencmode': 'disable',  # Supabase no usa GSSAPI: evita un intento extra al conectar
+            'application_name': 'farmacia-app',
+            # Mantiene vivas las conexiones del pool a través de NAT/balanceadores
+            'keepalives': 1,
+            'keepalives_idle': 30,
+            'keepalives_interval': 10,
+            'keepalives_count': 3
         }
+        
+        # Pool de conexiones persistentes (se crea en el primer uso)
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.pool = None
+        self._pool_lock = threading.Lock()
+        # ThreadedConnectionPool lanza error si se agota; así los hilos esperan turno
+        self._disponibles = threading.BoundedSemaphore(maxconn)
     
     def get_connection(self):
-        """Establece conexión con la base de datos"""
+        """Obtiene una conexión del pool"""
         try:
-            conn = psycopg2.connect(**self.config)
-            return conn
+            with self._pool_lock:
+                if self.pool is None:
+                    self.pool = pool.ThreadedConnectionPool(self.minconn, self.maxconn, **self.config)
+            return self.pool.getconn()
         except Exception as e:
+            # En tareas de segundo plano (sin script activo) el error se propaga
+            if get_script_run_ctx(suppress_warning=True) is None:
+                raise
             st.error(f"Error de conexión a base de datos: {str(e)}")
             return None
     
-    def execute_query(self, query, params=None, fetch=True):
-        """Ejecuta una consulta SQL"""
-        conn = self.get_connection()
-        if conn is None:
-            return None
-        
+    @contextmanager
+    def borrow(self):
+        """Toma prestada una conexión del pool y la devuelve al terminar"""
+        with self._disponibles:
+            conn = self.get_connection()
+            # Descartar conexiones que ya se sabe que están cerradas
+            if conn is not None and conn.closed:
+                self.pool.putconn(conn, close=True)
+                conn = self.get_connection()
+            try:
+                yield conn
+            finally:
+                if conn is not None:
+                    self.pool.putconn(conn, close=bool(conn.closed))
+    
+    @staticmethod
+    def _deshacer(conn):
+        """Rollback seguro: una conexión caída no tiene transacción que deshacer"""
+        if conn.closed:
+            return
         try:
-            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-                cursor.execute(query, params)
-                if fetch:
-                    result = cursor.fetchall()
-                    conn.commit()
-                    return result
-                else:
-                    conn.commit()
-                    return cursor.rowcount
-        except Exception as e:
             conn.rollback()
-            st.error(f"Error en consulta: {str(e)}")
-            return None
-        finally:
-            conn.close()
+        except psycopg2.Error:
+            pass
+    
+    @contextmanager
+    def transaction(self):
+        """Entrega un cursor en una transacción: commit al salir, rollback si hay error"""
+        with self.borrow() as conn:
+            if conn is None:
+                raise psycopg2.OperationalError("No hay conexión a la base de datos")
+            
+            try:
+                with conn.cursor() as cursor:
+                    yield cursor
+                conn.commit()
+            except Exception:
+                self._deshacer(conn)
+                raise
+    
+    def execute_query(self, query, params=None, fetch=True, cursor_factory=RealDictCursor):
+        """Ejecuta una consulta SQL (cursor_factory=None retorna tuplas)"""
+        for intento in range(2):
+            with self.borrow() as conn:
+                if conn is None:
+                    return None
+                
+                try:
+                    with conn.cursor(cursor_factory=cursor_factory) as cursor:
+                        cursor.execute(query, params)
+                        if fetch:
+                            result = cursor.fetchall()
+                            conn.commit()
+                            return result
+                        else:
+                            conn.commit()
+                            return cursor.rowcount
+                except Exception as e:
+                    self._deshacer(conn)
+                    # Conexión caída (reinicio, timeout, red): una lectura se reintenta con otra
+                    if conn.closed and fetch and intento == 0:
+                        continue
+                    st.error(f"Error en consulta: {str(e)}")
+                    return None
     
     def execute_insert(self, query, params=None):
         """Ejecuta un INSERT y retorna el ID generado"""
-        conn = self.get_connection()
-        if conn is None:
-            return None
+        with self.borrow() as conn:
+            if conn is None:
+                return None
+            
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute(query, params)
+                    inserted_id = cursor.fetchone()[0]
+                    conn.commit()
+                    return inserted_id
+            except Exception as e:
+                self._deshacer(conn)
+                st.error(f"Error en inserción: {str(e)}")
+                return None
+    
+    def query_dataframe(self, query, params=None, columns=None):
+        """
+        Ejecuta una consulta y arma el DataFrame directamente desde tuplas.
+        columns es un dict {nombre: dtype}: cada columna se construye
+        como un arreglo NumPy ya tipado (sin inferencia de pandas).
+        Si la consulta falla lanza la excepción (tras st.error), para que
+        las funciones cacheadas no guarden un DataFrame vacío.
+        """
+        for intento in range(2):
+            with self.borrow() as conn:
+                if conn is None:
+                    raise psycopg2.OperationalError("No hay conexión a la base de datos")
+                
+                try:
+                    with conn.cursor() as cursor:
+                        cursor.execute(query, params)
+                        rows = cursor.fetchall()
+                        conn.commit()
+                    break
+                except Exception as e:
+                    self._deshacer(conn)
+                    if conn.closed and intento == 0:
+                        continue
+                    st.error(f"Error en consulta: {str(e)}")
+                    raise
         
-        try:
-            with conn.cursor() as cursor:
-                cursor.execute(query, params)
-                inserted_id = cursor.fetchone()[0]
-                conn.commit()
-                return inserted_id
-        except Exception as e:
-            conn.rollback()
-            st.error(f"Error en inserción: {str(e)}")
-            return None
-        finally:
-            conn.close()
+        return pd.DataFrame({
+            nombre: np.fromiter((row[i] for row in rows), dtype=dtype, count=len(rows))
+            for i, (nombre, dtype) in enumerate(columns.items())
+        })
+    
+    def stream_query(self, query, params=None, itersize=5000, cursor_factory=None):
+        """
+        Recorre el resultado con un cursor del servidor, por lotes de itersize filas.
+        Si la consulta falla lanza la excepción, para que quien consume no
+        tome un resultado truncado como completo.
+        """
+        for intento in range(2):
+            emitidas = False
+            with self.borrow() as conn:
+                if conn is None:
+                    raise psycopg2.OperationalError("No hay conexión a la base de datos")
+                
+                try:
+                    with conn.cursor(name='stream_query', cursor_factory=cursor_factory) as cursor:
+                        cursor.itersize = itersize
+                        cursor.execute(query, params)
+                        for fila in cursor:
+                            emitidas = True
+                            yield fila
+                    conn.commit()
+                    return
+                except Exception:
+                    self._deshacer(conn)
+                    # Solo se reintenta si aún no se entregó ninguna fila
+                    if conn.closed and intento == 0 and not emitidas:
+                        continue
+                    raise
+
+@st.cache_resource
+def get_db():
+    """Conexión compartida entre reruns y sesiones de Streamlit"""
+    return DatabaseConnection()
 
 # Instancia global de la base de datos
-db = DatabaseConnection()
+db = get_db()
 
 # ============================================
 # FUNCIONES DE CLIENTES
@@ -155,7 +289,7 @@ db = DatabaseConnection()
 
 def verificar_cliente_existente(telefono):
     """Verifica si un cliente existe en la base de datos"""
-    query = "SELECT * FROM clientes WHERE telefono = %s"
+    query = "SELECT id, nombre, direccion FROM clientes WHERE telefono = %s"
     result = db.execute_query(query, (telefono,))
     return result[0] if result else None
 
@@ -176,48 +310,168 @@ def registrar_nuevo_cliente(datos_cliente):
         datos_cliente.get('provincia', 'Lima'),
         datos_cliente.get('departamento', 'Lima')
     )
-    return db.execute_insert(query, params)
+    cliente_id = db.execute_insert(query, params)
+    
+    if cliente_id:
+        # "Clientes Totales" del dashboard está cacheado
+        obtener_metricas_dashboard.clear()
+    
+    return cliente_id
+
+def obtener_clientes(busqueda=None, limite=100):
+    """Obtiene los clientes más recientes, opcionalmente filtrados por nombre o teléfono"""
+    condiciones = ""
+    params = []
+    
+    if busqueda:
+        condiciones = "WHERE nombre ILIKE %s OR telefono ILIKE %s"
+        patron = f"%{busqueda}%"
+        params.extend([patron, patron])
+    
+    query = f"""
+        SELECT 
+            nombre, telefono, email, distrito,
+            total_compras, monto_total_gastado, ultima_compra
+        FROM clientes 
+        {condiciones}
+        ORDER BY fecha_registro DESC
+        LIMIT %s
+    """
+    params.append(limite)
+    return db.execute_query(query, tuple(params))
 
 # ============================================
 # FUNCIONES DE MEDICAMENTOS
 # ============================================
 
-def obtener_medicamentos_disponibles():
-    """Obtiene todos los medicamentos con stock disponible"""
+CATEGORIAS_MEDICAMENTOS = [
+    "Analgésicos", "Antibióticos", "Vitaminas", "Cardiovascular", 
+    "Gastroenterología", "Alergias", "Diabetes", "Respiratorio", "Otros"
+]
+
+MEDICAMENTOS_POR_PAGINA = 50
+MEDICAMENTOS_EN_SELECTOR = 200
+
+@st.cache_data(ttl=300, show_spinner=False)
+def obtener_categorias():
+    """
+    Obtiene las categorías presentes en el catálogo (lista corta, cacheada).
+    Si la consulta falla lanza OperationalError para que el error no quede en caché.
+    """
     query = """
-        SELECT * FROM medicamentos 
-        WHERE activo = TRUE AND stock > 0
+        SELECT DISTINCT categoria FROM medicamentos
+        WHERE activo = TRUE AND categoria IS NOT NULL
+        ORDER BY 1
+    """
+    result = db.execute_query(query, cursor_factory=None)
+    if result is None:
+        raise psycopg2.OperationalError("No se pudieron obtener las categorías")
+    return [fila[0] for fila in result]
+
+@st.cache_data(ttl=30, show_spinner=False)
+def obtener_medicamentos_disponibles(categoria=None, busqueda=None, limite=MEDICAMENTOS_EN_SELECTOR, offset=0):
+    """Obtiene una página de medicamentos con stock, filtrando en la base de datos"""
+    condiciones = ["activo = TRUE", "stock > 0"]
+    params = []
+    
+    if categoria:
+        condiciones.append("categoria = %s")
+        params.append(categoria)
+    
+    if busqueda:
+        condiciones.append("(nombre ILIKE %s OR codigo ILIKE %s)")
+        patron = f"%{busqueda}%"
+        params.extend([patron, patron])
+    
+    query = f"""
+        SELECT 
+            id, codigo, nombre, categoria, laboratorio,
+            precio_unitario, stock, stock_minimo
+        FROM medicamentos 
+        WHERE {' AND '.join(condiciones)}
         ORDER BY categoria, nombre
+        LIMIT %s OFFSET %s
+    """
+    params.extend([limite, offset])
+    
+    result = db.execute_query(query, tuple(params))
+    if result is None:
+        raise psycopg2.OperationalError("No se pudo obtener el catálogo de medicamentos")
+    return pd.DataFrame(result) if result else pd.DataFrame()
+
+@st.cache_data(ttl=30, show_spinner=False)
+def obtener_medicamentos_stock_bajo():
+    """Obtiene todos los medicamentos activos en o bajo su stock mínimo"""
+    query = """
+        SELECT codigo, nombre, stock, stock_minimo
+        FROM medicamentos
+        WHERE activo = TRUE AND stock <= stock_minimo
+        ORDER BY stock, nombre
     """
     result = db.execute_query(query)
+    if result is None:
+        raise psycopg2.OperationalError("No se pudo obtener el stock bajo")
     return pd.DataFrame(result) if result else pd.DataFrame()
 
-def verificar_stock_medicamento(medicamento_id, cantidad):
-    """Verifica si hay stock suficiente"""
-    query = "SELECT stock FROM medicamentos WHERE id = %s"
-    result = db.execute_query(query, (medicamento_id,))
-    if result:
-        return result[0]['stock'] >= cantidad
-    return False
+def verificar_stock_lote(cantidades_por_id):
+    """Verifica en una sola consulta si hay stock suficiente para cada medicamento.
+    
+    Recibe {medicamento_id: cantidad} y devuelve {medicamento_id: bool}.
+    """
+    ids = [int(medicamento_id) for medicamento_id in cantidades_por_id]
+    query = "SELECT id, stock FROM medicamentos WHERE id = ANY(%s)"
+    result = db.execute_query(query, (ids,), cursor_factory=None) or []
+    stock_por_id = dict(result)
+    return {
+        medicamento_id: stock_por_id.get(int(medicamento_id), 0) >= cantidad
+        for medicamento_id, cantidad in cantidades_por_id.items()
+    }
 
 # ============================================
 # FUNCIONES DE PEDIDOS
 # ============================================
 
+COLUMNAS_CARRITO = {
+    'medicamento_id': 'int64',
+    'codigo': 'object',
+    'nombre': 'object',
+    'cantidad': 'int64',
+    'precio_unitario': 'float64',
+    'subtotal': 'float64',
+}
+
+def carrito_vacio():
+    """Devuelve un carrito vacío con las columnas ya tipadas"""
+    return pd.DataFrame({col: pd.Series(dtype=tipo) for col, tipo in COLUMNAS_CARRITO.items()})
+
 def generar_numero_pedido():
     """Genera un número único de pedido"""
     timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
     return f"PED-{timestamp}"
 
-def crear_pedido(cliente_id, items, direccion_envio, observaciones=""):
-    """Crea un nuevo pedido en la base de datos"""
-    # Calcular totales
-    subtotal = sum(item['subtotal'] for item in items)
+def crear_pedido(cliente_id, items, direccion_envio, observaciones="", estado='PENDIENTE'):
+    """Crea un nuevo pedido en la base de datos con el estado inicial indicado.
+    
+    `items` es el DataFrame del carrito (ver COLUMNAS_CARRITO).
+    """
+    # Calcular totales sobre columnas NumPy
+    cantidades = items['cantidad'].to_numpy(dtype=np.int64)
+    precios = items['precio_unitario'].to_numpy(dtype=np.float64)
+    subtotales = cantidades * precios
+    subtotal = float(subtotales.sum())
     impuesto = subtotal * 0.18  # IGV 18%
     total = subtotal + impuesto
+    cantidades_por_id = items.groupby('medicamento_id')['cantidad'].sum()
     
     numero_pedido = generar_numero_pedido()
     
+    # Verificación de stock orientativa: la proforma no descuenta stock, así
+    # que no se bloquean filas; solo se evita registrar un pedido ya imposible
+    query_stock = """
+        SELECT id, nombre, stock FROM medicamentos
+        WHERE id = ANY(%s)
+    """
+    
     # Insertar pedido
     query_pedido = """
         INSERT INTO pedidos (
@@ -229,60 +483,128 @@ def crear_pedido(cliente_id, items, direccion_envio, observaciones=""):
     """
     params_pedido = (
         numero_pedido, cliente_id, subtotal, impuesto, 
-        total, 'PENDIENTE', direccion_envio, observaciones
+        total, estado, direccion_envio, observaciones
     )
     
-    pedido_id = db.execute_insert(query_pedido, params_pedido)
+    # Insertar detalles del pedido (un solo INSERT multi-fila)
+    query_detalle = """
+        INSERT INTO detalle_pedidos (
+            pedido_id, medicamento_id, codigo_medicamento, 
+            nombre_medicamento, cantidad, precio_unitario, 
+            subtotal, total_item
+        )
+        VALUES %s
+    """
     
-    if pedido_id:
-        # Insertar detalles del pedido
-        for item in items:
-            query_detalle = """
-                INSERT INTO detalle_pedidos (
-                    pedido_id, medicamento_id, codigo_medicamento, 
-                    nombre_medicamento, cantidad, precio_unitario, 
-                    subtotal, total_item
+    # Pedido y detalles en la misma transacción (un solo commit)
+    try:
+        with db.transaction() as cursor:
+            cursor.execute(query_stock, (cantidades_por_id.index.tolist(),))
+            stock_actual = {fila[0]: (fila[1], fila[2]) for fila in cursor.fetchall()}
+            sin_stock = [
+                stock_actual.get(medicamento_id, (f"ID {medicamento_id}", 0))[0]
+                for medicamento_id, cantidad in cantidades_por_id.items()
+                if stock_actual.get(medicamento_id, (None, 0))[1] < cantidad
+            ]
+            if sin_stock:
+                raise ValueError(f"stock insuficiente para {', '.join(sin_stock)}")
+            
+            cursor.execute(query_pedido, params_pedido)
+            pedido_id = cursor.fetchone()[0]
+            
+            filas_detalle = [
+                (pedido_id, medicamento_id, codigo, nombre,
+                 cantidad, precio, subtotal_item, subtotal_item)
+                for medicamento_id, codigo, nombre, cantidad, precio, subtotal_item in zip(
+                    items['medicamento_id'].tolist(), items['codigo'].tolist(),
+                    items['nombre'].tolist(), cantidades.tolist(), precios.tolist(),
+                    subtotales.tolist()
                 )
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            """
-            params_detalle = (
-                pedido_id, item['medicamento_id'], item['codigo'],
-                item['nombre'], item['cantidad'], item['precio_unitario'],
-                item['subtotal'], item['subtotal']
-            )
-            db.execute_query(query_detalle, params_detalle, fetch=False)
-        
-        return pedido_id, numero_pedido, total
+            ]
+            execute_values(cursor, query_detalle, filas_detalle, page_size=100)
+    except Exception as e:
+        st.error(f"Error al crear pedido: {str(e)}")
+        return None, None, None
     
-    return None, None, None
+    invalidar_cache_reportes()
+    return pedido_id, numero_pedido, total
 
 def actualizar_estado_pedido(pedido_id, nuevo_estado):
     """Actualiza el estado de un pedido"""
     query = """
         UPDATE pedidos 
-        SET estado = %s, 
-            fecha_confirmacion = CASE WHEN %s = 'CONFIRMADO' THEN CURRENT_TIMESTAMP ELSE fecha_confirmacion END,
-            fecha_pago = CASE WHEN %s = 'PAGADO' THEN CURRENT_TIMESTAMP ELSE fecha_pago END,
-            fecha_envio = CASE WHEN %s = 'ENVIADO' THEN CURRENT_TIMESTAMP ELSE fecha_envio END
-        WHERE id = %s
+        SET estado = %(estado)s, 
+            fecha_confirmacion = COALESCE(fecha_confirmacion, CASE WHEN %(estado)s = 'CONFIRMADO' THEN CURRENT_TIMESTAMP END),
+            fecha_pago = COALESCE(fecha_pago, CASE WHEN %(estado)s = 'PAGADO' THEN CURRENT_TIMESTAMP END),
+            fecha_envio = COALESCE(fecha_envio, CASE WHEN %(estado)s = 'ENVIADO' THEN CURRENT_TIMESTAMP END)
+        WHERE id = %(id)s
     """
-    return db.execute_query(query, (nuevo_estado, nuevo_estado, nuevo_estado, nuevo_estado, pedido_id), fetch=False)
+    result = db.execute_query(query, {'estado': nuevo_estado, 'id': pedido_id}, fetch=False)
+    if result:
+        invalidar_cache_reportes()
+    return result
 
 def registrar_pago(pedido_id, monto, metodo_pago, referencia):
-    """Registra un pago en la base de datos"""
+    """Registra un pago y marca el pedido como PAGADO en una sola sentencia"""
     query = """
-        INSERT INTO pagos (pedido_id, monto, metodo_pago, referencia)
-        VALUES (%s, %s, %s, %s)
-        RETURNING id
+        WITH pago AS (
+            INSERT INTO pagos (pedido_id, monto, metodo_pago, referencia)
+            VALUES (%(pedido_id)s, %(monto)s, %(metodo_pago)s, %(referencia)s)
+            RETURNING id
+        )
+        UPDATE pedidos 
+        SET estado = 'PAGADO',
+            fecha_pago = COALESCE(fecha_pago, CURRENT_TIMESTAMP)
+        WHERE id = %(pedido_id)s
+        RETURNING (SELECT id FROM pago) as pago_id
     """
-    pago_id = db.execute_insert(query, (pedido_id, monto, metodo_pago, referencia))
+    params = {
+        'pedido_id': pedido_id,
+        'monto': monto,
+        'metodo_pago': metodo_pago,
+        'referencia': referencia
+    }
+    pago_id = db.execute_insert(query, params)
     
     if pago_id:
-        # Actualizar estado del pedido
-        actualizar_estado_pedido(pedido_id, 'PAGADO')
+        invalidar_cache_reportes()
     
     return pago_id
 
+PEDIDOS_POR_PAGINA = 20
+
+def obtener_pedidos(estado=None, despues_de=None, limite=PEDIDOS_POR_PAGINA):
+    """
+    Obtiene una página de pedidos, más recientes primero.
+    despues_de es el (fecha_pedido, id) del último pedido de la página anterior
+    (paginación por keyset, sin OFFSET).
+    """
+    condiciones = []
+    params = []
+    
+    if estado:
+        condiciones.append("p.estado = %s")
+        params.append(estado)
+    
+    if despues_de:
+        condiciones.append("(p.fecha_pedido, p.id) < (%s, %s)")
+        params.extend(despues_de)
+    
+    where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+    query = f"""
+        SELECT 
+            p.id, p.numero_pedido, p.estado, p.total,
+            p.fecha_pedido, p.direccion_envio,
+            c.nombre as cliente_nombre, c.telefono
+        FROM pedidos p
+        JOIN clientes c ON p.cliente_id = c.id
+        {where}
+        ORDER BY p.fecha_pedido DESC, p.id DESC
+        LIMIT %s
+    """
+    params.append(limite)
+    return db.execute_query(query, tuple(params))
+
 # ============================================
 # FUNCIONES DE GENERACIÓN DE QR
 # ============================================
@@ -299,27 +621,93 @@ def generar_qr_pedido(pedido_info):
     
     # Generar QR
     qr = qrcode.QRCode(version=1, box_size=10, border=5)
-    qr.add_data(json.dumps(qr_data))
+    qr.add_data(orjson.dumps(qr_data).decode())
     qr.make(fit=True)
     
     img = qr.make_image(fill_color="black", back_color="white")
     
-    # Convertir a base64
+    # Retornar el PNG en memoria, listo para reportlab
     buffer = BytesIO()
     img.save(buffer, format='PNG')
-    qr_base64 = base64.b64encode(buffer.getvalue()).decode()
+    buffer.seek(0)
     
-    return qr_base64
+    return buffer
 
 # ============================================
 # FUNCIONES DE GENERACIÓN DE PDF
 # ============================================
 
+# Estilos compartidos por todos los PDF (se construyen una sola vez)
+_ESTILOS = getSampleStyleSheet()
+
+_ESTILO_TITULO_VOUCHER = ParagraphStyle(
+    'CustomTitle',
+    parent=_ESTILOS['Heading1'],
+    fontSize=24,
+    textColor=colors.HexColor('#1f77b4'),
+    spaceAfter=30,
+    alignment=1
+)
+
+_ESTILO_TITULO_REPORTE = ParagraphStyle(
+    'CustomTitle',
+    parent=_ESTILOS['Heading1'],
+    fontSize=20,
+    textColor=colors.HexColor('#1f77b4'),
+    spaceAfter=20,
+    alignment=1
+)
+
+_ESTILO_TABLA_INFO = TableStyle([
+    ('BACKGROUND', (0, 0), (0, -1), colors.grey),
+    ('TEXTCOLOR', (0, 0), (0, -1), colors.whitesmoke),
+    ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+    ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, -1), 10),
+    ('BOTTOMPADDING', (0, 0), (-1, -1), 12),
+    ('BACKGROUND', (1, 0), (1, -1), colors.beige),
+    ('GRID', (0, 0), (-1, -1), 1, colors.black)
+])
+
+_ESTILO_TABLA_PRODUCTOS = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#1f77b4')),
+    ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+    ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, 0), 11),
+    ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+    ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
+    ('GRID', (0, 0), (-1, -1), 1, colors.black)
+])
+
+_ESTILO_TABLA_TOTALES = TableStyle([
+    ('ALIGN', (0, 0), (-1, -1), 'RIGHT'),
+    ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, -1), (-1, -1), 12),
+    ('TEXTCOLOR', (0, -1), (-1, -1), colors.HexColor('#1f77b4')),
+    ('LINEABOVE', (0, -1), (-1, -1), 2, colors.black),
+])
+
+_ESTILO_TABLA_VENTAS = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#1f77b4')),
+    ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+    ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, 0), 11),
+    ('BACKGROUND', (0, 1), (-1, -2), colors.beige),
+    ('BACKGROUND', (0, -1), (-1, -1), colors.grey),
+    ('TEXTCOLOR', (0, -1), (-1, -1), colors.whitesmoke),
+    ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
+    ('GRID', (0, 0), (-1, -1), 1, colors.black)
+])
+
 def generar_voucher_pdf(pedido_id):
     """Genera un voucher de venta en PDF"""
     # Obtener datos del pedido
     query = """
-        SELECT p.*, c.nombre as cliente_nombre, c.telefono, c.direccion
+        SELECT 
+            p.numero_pedido, p.fecha_pedido, p.subtotal, p.impuesto, p.total,
+            c.nombre as cliente_nombre, c.telefono, c.direccion
         FROM pedidos p
         JOIN clientes c ON p.cliente_id = c.id
         WHERE p.id = %s
@@ -328,26 +716,18 @@ def generar_voucher_pdf(pedido_id):
     
     # Obtener detalles
     query_detalles = """
-        SELECT * FROM detalle_pedidos WHERE pedido_id = %s
+        SELECT codigo_medicamento, nombre_medicamento, cantidad, precio_unitario, total_item
+        FROM detalle_pedidos WHERE pedido_id = %s
     """
-    detalles = db.execute_query(query_detalles, (pedido_id,))
+    detalles = db.execute_query(query_detalles, (pedido_id,), cursor_factory=None) or []
     
     # Crear PDF
     buffer = BytesIO()
     doc = SimpleDocTemplate(buffer, pagesize=A4)
     elements = []
-    styles = getSampleStyleSheet()
     
     # Título
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Heading1'],
-        fontSize=24,
-        textColor=colors.HexColor('#1f77b4'),
-        spaceAfter=30,
-        alignment=1
-    )
-    elements.append(Paragraph("VOUCHER DE VENTA", title_style))
+    elements.append(Paragraph("VOUCHER DE VENTA", _ESTILO_TITULO_VOUCHER))
     elements.append(Spacer(1, 0.3*inch))
     
     # Información del pedido
@@ -360,44 +740,22 @@ def generar_voucher_pdf(pedido_id):
     ]
     
     info_table = Table(info_data, colWidths=[2*inch, 4*inch])
-    info_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (0, -1), colors.grey),
-        ('TEXTCOLOR', (0, 0), (0, -1), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, -1), 10),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 12),
-        ('BACKGROUND', (1, 0), (1, -1), colors.beige),
-        ('GRID', (0, 0), (-1, -1), 1, colors.black)
-    ]))
+    info_table.setStyle(_ESTILO_TABLA_INFO)
     elements.append(info_table)
     elements.append(Spacer(1, 0.3*inch))
     
     # Tabla de productos
-    elements.append(Paragraph("Detalle del Pedido", styles['Heading2']))
+    elements.append(Paragraph("Detalle del Pedido", _ESTILOS['Heading2']))
     elements.append(Spacer(1, 0.2*inch))
     
     productos_data = [['Código', 'Medicamento', 'Cantidad', 'P. Unit.', 'Subtotal']]
-    for detalle in detalles:
-        productos_data.append([
-            detalle['codigo_medicamento'],
-            detalle['nombre_medicamento'],
-            str(detalle['cantidad']),
-            f"S/ {detalle['precio_unitario']:.2f}",
-            f"S/ {detalle['total_item']:.2f}"
-        ])
+    productos_data.extend([
+        [codigo, nombre, str(cantidad), f"S/ {precio:.2f}", f"S/ {total_item:.2f}"]
+        for codigo, nombre, cantidad, precio, total_item in detalles
+    ])
     
     productos_table = Table(productos_data, colWidths=[1*inch, 2.5*inch, 1*inch, 1*inch, 1*inch])
-    productos_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#1f77b4')),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 11),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-        ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-        ('GRID', (0, 0), (-1, -1), 1, colors.black)
-    ]))
+    productos_table.setStyle(_ESTILO_TABLA_PRODUCTOS)
     elements.append(productos_table)
     elements.append(Spacer(1, 0.3*inch))
     
@@ -409,13 +767,7 @@ def generar_voucher_pdf(pedido_id):
     ]
     
     totales_table = Table(totales_data, colWidths=[4.5*inch, 2*inch])
-    totales_table.setStyle(TableStyle([
-        ('ALIGN', (0, 0), (-1, -1), 'RIGHT'),
-        ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, -1), (-1, -1), 12),
-        ('TEXTCOLOR', (0, -1), (-1, -1), colors.HexColor('#1f77b4')),
-        ('LINEABOVE', (0, -1), (-1, -1), 2, colors.black),
-    ]))
+    totales_table.setStyle(_ESTILO_TABLA_TOTALES)
     elements.append(totales_table)
     
     # Generar QR
@@ -425,14 +777,12 @@ def generar_voucher_pdf(pedido_id):
         'total': pedido['total'],
         'fecha': pedido['fecha_pedido']
     }
-    qr_base64 = generar_qr_pedido(pedido_info)
+    qr_buffer = generar_qr_pedido(pedido_info)
     
     # Agregar QR al PDF
     elements.append(Spacer(1, 0.3*inch))
-    elements.append(Paragraph("Código QR del Pedido", styles['Heading3']))
+    elements.append(Paragraph("Código QR del Pedido", _ESTILOS['Heading3']))
     
-    qr_image_data = base64.b64decode(qr_base64)
-    qr_buffer = BytesIO(qr_image_data)
     qr_img = Image(qr_buffer, width=2*inch, height=2*inch)
     elements.append(qr_img)
     
@@ -441,9 +791,14 @@ def generar_voucher_pdf(pedido_id):
     buffer.seek(0)
     return buffer
 
+@st.cache_data(max_entries=32, show_spinner="Generando voucher...")
+def obtener_voucher_pdf(pedido_id):
+    """Bytes del voucher de un pedido; se genera una sola vez por pedido"""
+    return generar_voucher_pdf(pedido_id).getvalue()
+
 def generar_reporte_ventas_pdf(fecha_inicio, fecha_fin):
     """Genera un reporte de ventas en PDF"""
-    # Obtener datos
+    # Obtener datos (ROLLUP agrega la fila de totales con fecha NULL al final)
     query = """
         SELECT 
             DATE(fecha_pedido) as fecha,
@@ -451,68 +806,44 @@ def generar_reporte_ventas_pdf(fecha_inicio, fecha_fin):
             SUM(total) as monto_total
         FROM pedidos
         WHERE estado IN ('PAGADO', 'ENVIADO', 'ENTREGADO')
-        AND fecha_pedido BETWEEN %s AND %s
-        GROUP BY DATE(fecha_pedido)
-        ORDER BY fecha
+        AND fecha_pedido >= %s AND fecha_pedido < %s::date + 1
+        GROUP BY ROLLUP(DATE(fecha_pedido))
+        ORDER BY fecha NULLS LAST
     """
-    ventas = db.execute_query(query, (fecha_inicio, fecha_fin))
     
     buffer = BytesIO()
     doc = SimpleDocTemplate(buffer, pagesize=A4)
     elements = []
-    styles = getSampleStyleSheet()
     
     # Título
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Heading1'],
-        fontSize=20,
-        textColor=colors.HexColor('#1f77b4'),
-        spaceAfter=20,
-        alignment=1
-    )
-    elements.append(Paragraph("REPORTE DE VENTAS", title_style))
-    elements.append(Paragraph(f"Período: {fecha_inicio} al {fecha_fin}", styles['Normal']))
+    elements.append(Paragraph("REPORTE DE VENTAS", _ESTILO_TITULO_REPORTE))
+    elements.append(Paragraph(f"Período: {fecha_inicio} al {fecha_fin}", _ESTILOS['Normal']))
     elements.append(Spacer(1, 0.3*inch))
     
-    # Tabla de ventas
-    if ventas:
-        ventas_data = [['Fecha', 'Total Pedidos', 'Monto Total']]
-        total_pedidos = 0
-        total_monto = 0
-        
-        for venta in ventas:
-            ventas_data.append([
-                venta['fecha'].strftime('%d/%m/%Y'),
-                str(venta['total_pedidos']),
-                f"S/ {venta['monto_total']:.2f}"
-            ])
-            total_pedidos += venta['total_pedidos']
-            total_monto += float(venta['monto_total'])
-        
-        ventas_data.append(['TOTALES', str(total_pedidos), f"S/ {total_monto:.2f}"])
-        
+    # Tabla de ventas (filas leídas por lotes desde el servidor)
+    ventas_data = [['Fecha', 'Total Pedidos', 'Monto Total']]
+    ventas_data.extend([
+        [fecha.strftime('%d/%m/%Y') if fecha else 'TOTALES', str(pedidos), f"S/ {monto or 0:.2f}"]
+        for fecha, pedidos, monto in db.stream_query(query, (fecha_inicio, fecha_fin))
+    ])
+    
+    # Encabezado + al menos un día + totales
+    if len(ventas_data) > 2:
         ventas_table = Table(ventas_data, colWidths=[2*inch, 2*inch, 2*inch])
-        ventas_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#1f77b4')),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 0), 11),
-            ('BACKGROUND', (0, 1), (-1, -2), colors.beige),
-            ('BACKGROUND', (0, -1), (-1, -1), colors.grey),
-            ('TEXTCOLOR', (0, -1), (-1, -1), colors.whitesmoke),
-            ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black)
-        ]))
+        ventas_table.setStyle(_ESTILO_TABLA_VENTAS)
         elements.append(ventas_table)
     else:
-        elements.append(Paragraph("No hay datos para el período seleccionado", styles['Normal']))
+        elements.append(Paragraph("No hay datos para el período seleccionado", _ESTILOS['Normal']))
     
     doc.build(elements)
     buffer.seek(0)
     return buffer
 
+@st.cache_data(ttl=60, max_entries=32, show_spinner="Generando reporte...")
+def obtener_reporte_ventas_pdf(fecha_inicio, fecha_fin):
+    """Bytes del reporte de ventas de un período"""
+    return generar_reporte_ventas_pdf(fecha_inicio, fecha_fin).getvalue()
+
 # ============================================
 # SIMULACIÓN DE WHATSAPP (Función placeholder)
 # ============================================
@@ -521,64 +852,132 @@ def enviar_whatsapp(telefono, mensaje, tipo, pedido_id=None, cliente_id=None):
     """
     Simula el envío de mensajes por WhatsApp
     En producción, integrar con API de WhatsApp Business
+    
+    Se ejecuta en segundo plano: no usa st.* y los errores se propagan
+    al Future (ver en_segundo_plano).
     """
-    try:
-        # Registrar en base de datos
-        query = """
-            INSERT INTO notificaciones_whatsapp 
-            (pedido_id, cliente_id, telefono, tipo, mensaje)
-            VALUES (%s, %s, %s, %s, %s)
-        """
-        db.execute_query(query, (pedido_id, cliente_id, telefono, tipo, mensaje), fetch=False)
-        
-        # Aquí iría la integración real con WhatsApp API
-        # Por ejemplo: Twilio, WhatsApp Business API, etc.
-        
-        return True
-    except Exception as e:
-        st.error(f"Error al enviar WhatsApp: {str(e)}")
-        return False
+    # Registrar en base de datos
+    query = """
+        INSERT INTO notificaciones_whatsapp 
+        (pedido_id, cliente_id, telefono, tipo, mensaje)
+        VALUES (%s, %s, %s, %s, %s)
+    """
+    with db.transaction() as cursor:
+        cursor.execute(query, (pedido_id, cliente_id, telefono, tipo, mensaje))
+    
+    # Aquí iría la integración real con WhatsApp API
+    # Por ejemplo: Twilio, WhatsApp Business API, etc.
+    
+    return True
 
 # ============================================
 # FUNCIONES DE REPORTES Y ESTADÍSTICAS
 # ============================================
 
-def obtener_metricas_dashboard():
-    """Obtiene métricas para el dashboard"""
-    # Ventas del día
-    query_hoy = """
-        SELECT COUNT(*) as pedidos, COALESCE(SUM(total), 0) as monto
-        FROM pedidos
-        WHERE DATE(fecha_pedido) = CURRENT_DATE
-        AND estado IN ('PAGADO', 'ENVIADO', 'ENTREGADO')
-    """
-    ventas_hoy = db.execute_query(query_hoy)[0]
+@st.cache_resource
+def get_pool_consultas():
+    """Hilos compartidos entre sesiones para cargar consultas en paralelo"""
+    return ThreadPoolExecutor(max_workers=8)
+
+def cargar_en_paralelo(*tareas):
+    """Ejecuta consultas independientes en paralelo y retorna sus resultados en orden"""
+    ctx = get_script_run_ctx()
     
-    # Ventas del mes
-    query_mes = """
-        SELECT COUNT(*) as pedidos, COALESCE(SUM(total), 0) as monto
-        FROM pedidos
-        WHERE EXTRACT(MONTH FROM fecha_pedido) = EXTRACT(MONTH FROM CURRENT_DATE)
-        AND EXTRACT(YEAR FROM fecha_pedido) = EXTRACT(YEAR FROM CURRENT_DATE)
-        AND estado IN ('PAGADO', 'ENVIADO', 'ENTREGADO')
-    """
-    ventas_mes = db.execute_query(query_mes)[0]
+    def ejecutar(tarea):
+        # Permite que st.error y st.cache_data funcionen desde el hilo
+        hilo = threading.current_thread()
+        previo = getattr(hilo, SCRIPT_RUN_CONTEXT_ATTR_NAME, None)
+        add_script_run_ctx(hilo, ctx)
+        try:
+            funcion, *args = tarea
+            return funcion(*args)
+        finally:
+            # add_script_run_ctx(hilo, None) volvería a poner el contexto actual:
+            # se restaura el atributo para no dejar esta sesión pegada al hilo
+            setattr(hilo, SCRIPT_RUN_CONTEXT_ATTR_NAME, previo)
     
-    # Clientes totales
-    query_clientes = "SELECT COUNT(*) as total FROM clientes"
-    total_clientes = db.execute_query(query_clientes)[0]['total']
+    return list(get_pool_consultas().map(ejecutar, tareas))
+
+@st.cache_resource
+def get_executor():
+    """Hilos compartidos para tareas en segundo plano (notificaciones)"""
+    return ThreadPoolExecutor(max_workers=4)
+
+def _registrar_fallo(futuro):
+    """Deja en el log los errores de las tareas en segundo plano"""
+    error = futuro.exception()
+    if error is not None:
+        logger.error("Tarea en segundo plano fallida", exc_info=error)
+
+def en_segundo_plano(funcion, *args):
+    """
+    Envía una tarea al pool compartido y retorna su Future.
+    La tarea puede terminar después del rerun que la lanzó, así que corre sin
+    el contexto del script: no debe usar st.*; sus errores van al log.
+    """
+    def ejecutar():
+        # Sin contexto de ninguna sesión: get_connection propaga el error al Future
+        setattr(threading.current_thread(), SCRIPT_RUN_CONTEXT_ATTR_NAME, None)
+        return funcion(*args)
     
-    # Productos con stock bajo
-    query_stock = "SELECT COUNT(*) as total FROM medicamentos WHERE stock <= stock_minimo AND activo = TRUE"
-    stock_bajo = db.execute_query(query_stock)[0]['total']
+    futuro = get_executor().submit(ejecutar)
+    futuro.add_done_callback(_registrar_fallo)
+    return futuro
+
+def invalidar_cache_reportes():
+    """Descarta las consultas cacheadas que dependen de los pedidos"""
+    obtener_medicamentos_disponibles.clear()
+    obtener_medicamentos_stock_bajo.clear()
+    obtener_metricas_dashboard.clear()
+    obtener_ventas_diarias.clear()
+    obtener_productos_mas_vendidos.clear()
+    obtener_ventas_por_categoria.clear()
+    obtener_estadisticas_clientes.clear()
+    obtener_reporte_ventas.clear()
+    obtener_reporte_ventas_pdf.clear()
+
+@st.cache_data(ttl=60, show_spinner=False)
+def obtener_metricas_dashboard():
+    """Obtiene métricas para el dashboard en una sola consulta"""
+    query = """
+        WITH ventas AS (
+            -- Un solo recorrido del mes; el día actual se separa con FILTER
+            SELECT 
+                COUNT(*) FILTER (WHERE fecha_pedido >= CURRENT_DATE AND fecha_pedido < CURRENT_DATE + 1) as hoy_pedidos,
+                COALESCE(SUM(total) FILTER (WHERE fecha_pedido >= CURRENT_DATE AND fecha_pedido < CURRENT_DATE + 1), 0) as hoy_monto,
+                COUNT(*) as mes_pedidos,
+                COALESCE(SUM(total), 0) as mes_monto
+            FROM pedidos
+            WHERE fecha_pedido >= date_trunc('month', CURRENT_DATE)
+            AND fecha_pedido < date_trunc('month', CURRENT_DATE) + INTERVAL '1 month'
+            AND estado IN ('PAGADO', 'ENVIADO', 'ENTREGADO')
+        ),
+        clientes_totales AS (
+            SELECT COUNT(*) as total FROM clientes
+        ),
+        stock AS (
+            SELECT COUNT(*) as total FROM medicamentos WHERE stock <= stock_minimo AND activo = TRUE
+        )
+        SELECT 
+            ventas.hoy_pedidos, ventas.hoy_monto,
+            ventas.mes_pedidos, ventas.mes_monto,
+            clientes_totales.total as total_clientes,
+            stock.total as stock_bajo
+        FROM ventas, clientes_totales, stock
+    """
+    result = db.execute_query(query)
+    if result is None:
+        raise psycopg2.OperationalError("No se pudieron obtener las métricas")
+    fila = result[0]
     
     return {
-        'ventas_hoy': ventas_hoy,
-        'ventas_mes': ventas_mes,
-        'total_clientes': total_clientes,
-        'stock_bajo': stock_bajo
+        'ventas_hoy': {'pedidos': fila['hoy_pedidos'], 'monto': fila['hoy_monto']},
+        'ventas_mes': {'pedidos': fila['mes_pedidos'], 'monto': fila['mes_monto']},
+        'total_clientes': fila['total_clientes'],
+        'stock_bajo': fila['stock_bajo']
     }
 
+@st.cache_data(ttl=60, show_spinner=False)
 def obtener_ventas_diarias(dias=30):
     """Obtiene datos de ventas diarias para gráficos"""
     query = """
@@ -587,14 +986,37 @@ def obtener_ventas_diarias(dias=30):
             COUNT(*) as pedidos,
             SUM(total) as monto
         FROM pedidos
-        WHERE fecha_pedido >= CURRENT_DATE - INTERVAL '%s days'
+        WHERE fecha_pedido >= CURRENT_DATE - make_interval(days => %s)
         AND estado IN ('PAGADO', 'ENVIADO', 'ENTREGADO')
         GROUP BY DATE(fecha_pedido)
         ORDER BY fecha
     """
-    result = db.execute_query(query, (dias,))
-    return pd.DataFrame(result) if result else pd.DataFrame()
+    return db.query_dataframe(
+        query, (int(dias),),
+        columns={'fecha': 'datetime64[ns]', 'pedidos': np.int64, 'monto': np.float64}
+    )
+
+@st.cache_data(ttl=60, show_spinner=False)
+def obtener_reporte_ventas(fecha_inicio, fecha_fin):
+    """Obtiene las ventas por día de un período (ambas fechas incluidas)"""
+    query = """
+        SELECT 
+            DATE(fecha_pedido) as fecha,
+            COUNT(*) as total_pedidos,
+            SUM(total) as monto_total,
+            AVG(total) as ticket_promedio
+        FROM pedidos
+        WHERE estado IN ('PAGADO', 'ENVIADO', 'ENTREGADO')
+        AND fecha_pedido >= %s AND fecha_pedido < %s::date + 1
+        GROUP BY DATE(fecha_pedido)
+        ORDER BY fecha
+    """
+    result = db.execute_query(query, (fecha_inicio, fecha_fin))
+    if result is None:
+        raise psycopg2.OperationalError("No se pudo obtener el reporte de ventas")
+    return result
 
+@st.cache_data(ttl=60, show_spinner=False)
 def obtener_productos_mas_vendidos(limite=10):
     """Obtiene los productos más vendidos"""
     query = """
@@ -611,9 +1033,12 @@ def obtener_productos_mas_vendidos(limite=10):
         ORDER BY cantidad_vendida DESC
         LIMIT %s
     """
-    result = db.execute_query(query, (limite,))
-    return pd.DataFrame(result) if result else pd.DataFrame()
+    return db.query_dataframe(
+        query, (limite,),
+        columns={'nombre': object, 'categoria': object, 'cantidad_vendida': np.int64, 'ingresos': np.float64}
+    )
 
+@st.cache_data(ttl=60, show_spinner=False)
 def obtener_ventas_por_categoria():
     """Obtiene ventas agrupadas por categoría"""
     query = """
@@ -628,8 +1053,147 @@ def obtener_ventas_por_categoria():
         GROUP BY m.categoria
         ORDER BY ingresos DESC
     """
+    return db.query_dataframe(
+        query,
+        columns={'categoria': object, 'cantidad': np.int64, 'ingresos': np.float64}
+    )
+
+@st.cache_data(ttl=60, show_spinner=False)
+def obtener_estadisticas_clientes():
+    """Obtiene estadísticas globales de clientes y su distribución por categoría"""
+    query = """
+        SELECT 
+            COUNT(*) FILTER (WHERE total_compras > 0) as activos,
+            COALESCE(AVG(total_compras) FILTER (WHERE total_compras > 0), 0) as promedio_compras,
+            COALESCE(AVG(monto_total_gastado) FILTER (WHERE total_compras > 0), 0) as promedio_gastado,
+            COUNT(*) FILTER (WHERE categoria_cliente = 'VIP') as vip,
+            COUNT(*) FILTER (WHERE categoria_cliente = 'Frecuente') as frecuente,
+            COUNT(*) FILTER (WHERE categoria_cliente = 'Regular' AND total_compras > 0) as regular
+        FROM clientes
+    """
     result = db.execute_query(query)
-    return pd.DataFrame(result) if result else pd.DataFrame()
+    if result is None:
+        raise psycopg2.OperationalError("No se pudieron obtener las estadísticas de clientes")
+    return result[0]
+
+MAX_PUNTOS_GRAFICO = 120
+
+def reagrupar_ventas_para_grafico(df, columna_fecha, columna_monto, max_puntos=MAX_PUNTOS_GRAFICO):
+    """
+    Reduce una serie diaria de ventas a semanas o meses cuando tiene más de
+    max_puntos días, sumando los montos de cada periodo.
+    Retorna el DataFrame a graficar y el nombre del periodo.
+    """
+    if len(df) <= max_puntos:
+        return df, 'Día'
+    
+    frecuencia, periodo = ('W', 'Semana') if len(df) <= max_puntos * 7 else ('MS', 'Mes')
+    df_periodo = (
+        pd.DataFrame({
+            columna_fecha: pd.to_datetime(df[columna_fecha]),
+            columna_monto: df[columna_monto].astype(float)
+        })
+        .resample(frecuencia, on=columna_fecha)[columna_monto]
+        .sum()
+        .reset_index()
+    )
+    return df_periodo, periodo
+
+# ============================================
+# GRÁFICOS
+# ============================================
+# Las figuras se cachean por el contenido del DataFrame: si los datos no
+# cambiaron entre reruns se reutiliza la misma figura. cache_resource la
+# devuelve tal cual; cache_data la reconstruiría al deserializarla.
+# Las figuras devueltas no deben modificarse.
+
+@st.cache_resource(max_entries=16, show_spinner=False)
+def grafico_ventas_diarias(df_ventas):
+    """Línea de ventas diarias del dashboard"""
+    # Scattergl: la línea se dibuja con WebGL en lugar de SVG
+    fig = go.Figure(go.Scattergl(
+        x=df_ventas['fecha'],
+        y=df_ventas['monto'],
+        mode='lines',
+        line=dict(color='#1f77b4', width=3)
+    ))
+    fig.update_layout(
+        title='Evolución de Ventas',
+        xaxis_title='Fecha',
+        yaxis_title='Monto (S/)',
+        uirevision='dashboard_ventas'
+    )
+    return fig
+
+@st.cache_resource(max_entries=16, show_spinner=False)
+def grafico_top_productos(df_top):
+    """Barras horizontales con los productos más vendidos"""
+    fig = px.bar(
+        df_top,
+        x='cantidad_vendida',
+        y='nombre',
+        orientation='h',
+        title='Productos con Mayor Demanda',
+        labels={'cantidad_vendida': 'Unidades Vendidas', 'nombre': 'Producto'},
+        color='cantidad_vendida',
+        color_continuous_scale='Blues'
+    )
+    fig.update_layout(uirevision='dashboard_top')
+    return fig
+
+@st.cache_resource(max_entries=16, show_spinner=False)
+def grafico_ventas_categoria(df_categorias, titulo, revision):
+    """Torta de ingresos por categoría"""
+    fig = px.pie(
+        df_categorias,
+        values='ingresos',
+        names='categoria',
+        title=titulo
+    )
+    fig.update_layout(uirevision=revision)
+    return fig
+
+# ============================================
+# COMPONENTES DE INTERFAZ
+# ============================================
+
+@st.fragment
+def mostrar_pedido(pedido):
+    """Muestra un pedido en Gestión de Pedidos; sus widgets solo re-ejecutan este bloque"""
+    with st.expander(f"📦 Pedido {pedido['numero_pedido']} - {pedido['estado']} - S/ {pedido['total']:.2f}"):
+        col_p1, col_p2 = st.columns([2, 1])
+        
+        with col_p1:
+            st.write(f"**Cliente:** {pedido['cliente_nombre']}")
+            st.write(f"**Teléfono:** {pedido['telefono']}")
+            st.write(f"**Fecha:** {pedido['fecha_pedido'].strftime('%d/%m/%Y %H:%M')}")
+            st.write(f"**Dirección:** {pedido['direccion_envio']}")
+        
+        with col_p2:
+            nuevo_estado = st.selectbox(
+                "Actualizar estado:",
+                ["PROFORMA_GENERADA", "CONFIRMADO", "PAGADO", "ENVIADO", "ENTREGADO", "CANCELADO"],
+                key=f"estado_{pedido['id']}"
+            )
+            
+            if st.button("💾 Actualizar", key=f"btn_{pedido['id']}"):
+                if actualizar_estado_pedido(pedido['id'], nuevo_estado):
+                    st.success("✅ Estado actualizado")
+                    
+                    # Solo se vuelve a dibujar este pedido, no toda la lista
+                    pedido['estado'] = nuevo_estado
+                    st.rerun(scope="fragment")
+            
+            # El voucher se genera solo cuando se pide
+            if pedido['estado'] in ('PAGADO', 'ENVIADO', 'ENTREGADO'):
+                if st.button("🧾 Preparar Voucher", key=f"voucher_{pedido['id']}"):
+                    st.download_button(
+                        label="📄 Descargar Voucher",
+                        data=obtener_voucher_pdf(pedido['id']),
+                        file_name=f"voucher_{pedido['numero_pedido']}.pdf",
+                        mime="application/pdf",
+                        key=f"descargar_voucher_{pedido['id']}"
+                    )
 
 # ============================================
 # INTERFAZ PRINCIPAL
@@ -656,8 +1220,17 @@ def main():
     if menu_option == "📊 Dashboard":
         st.header("Dashboard - Métricas en Tiempo Real")
         
-        # Obtener métricas
-        metricas = obtener_metricas_dashboard()
+        # Obtener métricas y datos de gráficos en paralelo
+        try:
+            metricas, df_ventas, df_top, df_categorias = cargar_en_paralelo(
+                (obtener_metricas_dashboard,),
+                (obtener_ventas_diarias, 30),
+                (obtener_productos_mas_vendidos, 10),
+                (obtener_ventas_por_categoria,)
+            )
+        except psycopg2.Error:
+            st.warning("No se pudieron cargar los datos del dashboard. Intente de nuevo.")
+            st.stop()
         
         # Métricas principales
         col1, col2, col3, col4 = st.columns(4)
@@ -697,47 +1270,23 @@ def main():
         
         with col_g1:
             st.subheader("📈 Ventas Últimos 30 Días")
-            df_ventas = obtener_ventas_diarias(30)
             if not df_ventas.empty:
-                fig_ventas = px.line(
-                    df_ventas, 
-                    x='fecha', 
-                    y='monto',
-                    title='Evolución de Ventas',
-                    labels={'fecha': 'Fecha', 'monto': 'Monto (S/)'}
-                )
-                fig_ventas.update_traces(line_color='#1f77b4', line_width=3)
-                st.plotly_chart(fig_ventas, use_container_width=True)
+                st.plotly_chart(grafico_ventas_diarias(df_ventas), use_container_width=True)
             else:
                 st.info("No hay datos de ventas disponibles")
         
         with col_g2:
             st.subheader("🏆 Top 10 Productos Más Vendidos")
-            df_top = obtener_productos_mas_vendidos(10)
             if not df_top.empty:
-                fig_top = px.bar(
-                    df_top.head(10),
-                    x='cantidad_vendida',
-                    y='nombre',
-                    orientation='h',
-                    title='Productos con Mayor Demanda',
-                    labels={'cantidad_vendida': 'Unidades Vendidas', 'nombre': 'Producto'},
-                    color='cantidad_vendida',
-                    color_continuous_scale='Blues'
-                )
-                st.plotly_chart(fig_top, use_container_width=True)
+                st.plotly_chart(grafico_top_productos(df_top), use_container_width=True)
             else:
                 st.info("No hay datos de productos vendidos")
         
         # Ventas por categoría
         st.subheader("📊 Ventas por Categoría")
-        df_categorias = obtener_ventas_por_categoria()
         if not df_categorias.empty:
-            fig_cat = px.pie(
-                df_categorias,
-                values='ingresos',
-                names='categoria',
-                title='Distribución de Ingresos por Categoría'
+            fig_cat = grafico_ventas_categoria(
+                df_categorias, 'Distribución de Ingresos por Categoría', 'dashboard_categorias'
             )
             st.plotly_chart(fig_cat, use_container_width=True)
         else:
@@ -751,7 +1300,8 @@ def main():
         
         # Inicializar carrito en session_state
         if 'carrito' not in st.session_state:
-            st.session_state.carrito = []
+            st.session_state.carrito = carrito_vacio()
+            st.session_state.carrito_subtotal = 0.0
         
         # Paso 1: Datos del cliente
         st.subheader("👤 Paso 1: Información del Cliente")
@@ -759,34 +1309,52 @@ def main():
         col_c1, col_c2 = st.columns(2)
         
         with col_c1:
-            telefono_cliente = st.text_input("📱 Teléfono*", placeholder="+51987654321")
+            # La búsqueda solo consulta la base de datos al pulsar "Buscar"
+            with st.form("buscar_cliente_form"):
+                telefono_cliente = st.text_input("📱 Teléfono*", placeholder="+51987654321")
+                buscar = st.form_submit_button("🔍 Buscar")
             
-            if telefono_cliente:
-                cliente_existente = verificar_cliente_existente(telefono_cliente)
+            if buscar and telefono_cliente:
+                st.session_state.telefono_buscado = telefono_cliente
+                st.session_state.cliente_buscado = verificar_cliente_existente(telefono_cliente)
+                for clave in ('cliente_id', 'cliente_nombre', 'cliente_direccion', 'cliente_telefono'):
+                    st.session_state.pop(clave, None)
                 
+                cliente_existente = st.session_state.cliente_buscado
                 if cliente_existente:
-                    st.success(f"✅ Cliente encontrado: {cliente_existente['nombre']}")
                     st.session_state.cliente_id = cliente_existente['id']
                     st.session_state.cliente_nombre = cliente_existente['nombre']
                     st.session_state.cliente_direccion = cliente_existente['direccion']
+                    st.session_state.cliente_telefono = telefono_cliente
+            
+            if 'telefono_buscado' in st.session_state:
+                telefono_buscado = st.session_state.telefono_buscado
+                cliente_existente = st.session_state.cliente_buscado
+                
+                if cliente_existente:
+                    st.success(f"✅ Cliente encontrado: {cliente_existente['nombre']}")
                 else:
                     st.info("🆕 Cliente nuevo - Complete los datos")
                     
-                    nombre = st.text_input("Nombre Completo*")
-                    email = st.text_input("Email")
-                    direccion = st.text_area("Dirección de Envío*")
-                    
-                    col_d1, col_d2 = st.columns(2)
-                    with col_d1:
-                        distrito = st.text_input("Distrito", value="Lima")
-                    with col_d2:
-                        referencia = st.text_input("Referencia")
+                    # Los datos se envían juntos: un solo rerun al registrar
+                    with st.form("nuevo_cliente_form"):
+                        nombre = st.text_input("Nombre Completo*")
+                        email = st.text_input("Email")
+                        direccion = st.text_area("Dirección de Envío*")
+                        
+                        col_d1, col_d2 = st.columns(2)
+                        with col_d1:
+                            distrito = st.text_input("Distrito", value="Lima")
+                        with col_d2:
+                            referencia = st.text_input("Referencia")
+                        
+                        registrar = st.form_submit_button("💾 Registrar Cliente")
                     
-                    if st.button("💾 Registrar Cliente"):
+                    if registrar:
                         if nombre and direccion:
                             datos_cliente = {
                                 'nombre': nombre,
-                                'telefono': telefono_cliente,
+                                'telefono': telefono_buscado,
                                 'email': email,
                                 'direccion': direccion,
                                 'distrito': distrito,
@@ -795,9 +1363,13 @@ def main():
                             cliente_id = registrar_nuevo_cliente(datos_cliente)
                             if cliente_id:
                                 st.success("✅ Cliente registrado exitosamente")
+                                st.session_state.cliente_buscado = {
+                                    'id': cliente_id, 'nombre': nombre, 'direccion': direccion
+                                }
                                 st.session_state.cliente_id = cliente_id
                                 st.session_state.cliente_nombre = nombre
                                 st.session_state.cliente_direccion = direccion
+                                st.session_state.cliente_telefono = telefono_buscado
                                 st.rerun()
                         else:
                             st.error("Complete los campos obligatorios")
@@ -807,16 +1379,31 @@ def main():
             st.markdown("---")
             st.subheader("💊 Paso 2: Seleccionar Medicamentos")
             
-            df_medicamentos = obtener_medicamentos_disponibles()
+            busqueda_medicamento = st.text_input("🔍 Buscar medicamento:", placeholder="Nombre o código")
+            try:
+                df_medicamentos = obtener_medicamentos_disponibles(busqueda=busqueda_medicamento or None)
+            except psycopg2.Error:
+                df_medicamentos = pd.DataFrame()
+            
+            if len(df_medicamentos) == MEDICAMENTOS_EN_SELECTOR:
+                st.caption(
+                    f"Se muestran los primeros {MEDICAMENTOS_EN_SELECTOR} medicamentos; "
+                    "refine la búsqueda para encontrar otros."
+                )
             
             if not df_medicamentos.empty:
+                # Búsqueda O(1) por id para el selectbox y el carrito
+                med_index = df_medicamentos.set_index('id')[
+                    ['codigo', 'nombre', 'precio_unitario', 'stock']
+                ].to_dict('index')
+                
                 col_m1, col_m2, col_m3 = st.columns([3, 1, 1])
                 
                 with col_m1:
                     medicamento_seleccionado = st.selectbox(
                         "Seleccione medicamento:",
-                        options=df_medicamentos['id'].tolist(),
-                        format_func=lambda x: f"{df_medicamentos[df_medicamentos['id']==x]['nombre'].values[0]} - S/ {df_medicamentos[df_medicamentos['id']==x]['precio_unitario'].values[0]:.2f} (Stock: {df_medicamentos[df_medicamentos['id']==x]['stock'].values[0]})"
+                        options=list(med_index),
+                        format_func=lambda x: f"{med_index[x]['nombre']} - S/ {med_index[x]['precio_unitario']:.2f} (Stock: {med_index[x]['stock']})"
                     )
                 
                 with col_m2:
@@ -824,36 +1411,46 @@ def main():
                 
                 with col_m3:
                     if st.button("➕ Agregar al Carrito", use_container_width=True):
-                        med_data = df_medicamentos[df_medicamentos['id'] == medicamento_seleccionado].iloc[0]
+                        med_data = med_index[medicamento_seleccionado]
                         
-                        if verificar_stock_medicamento(medicamento_seleccionado, cantidad):
-                            item = {
-                                'medicamento_id': medicamento_seleccionado,
-                                'codigo': med_data['codigo'],
-                                'nombre': med_data['nombre'],
-                                'cantidad': cantidad,
-                                'precio_unitario': float(med_data['precio_unitario']),
-                                'subtotal': float(med_data['precio_unitario']) * cantidad
-                            }
-                            st.session_state.carrito.append(item)
+                        carrito = st.session_state.carrito
+                        en_carrito = int(carrito.loc[carrito['medicamento_id'] == medicamento_seleccionado, 'cantidad'].sum())
+                        stock_ok = verificar_stock_lote({medicamento_seleccionado: en_carrito + cantidad})
+                        
+                        if stock_ok[medicamento_seleccionado]:
+                            precio = float(med_data['precio_unitario'])
+                            carrito.loc[len(carrito)] = [
+                                medicamento_seleccionado, med_data['codigo'], med_data['nombre'],
+                                cantidad, precio, precio * cantidad
+                            ]
+                            st.session_state.carrito_subtotal += precio * cantidad
                             st.success(f"✅ {med_data['nombre']} agregado al carrito")
                             st.rerun()
                         else:
                             st.error("❌ Stock insuficiente")
                 
                 # Mostrar carrito
-                if st.session_state.carrito:
+                if not st.session_state.carrito.empty:
                     st.markdown("---")
                     st.subheader("🛒 Carrito de Compras")
                     
-                    df_carrito = pd.DataFrame(st.session_state.carrito)
-                    df_carrito_display = df_carrito[['codigo', 'nombre', 'cantidad', 'precio_unitario', 'subtotal']]
-                    df_carrito_display.columns = ['Código', 'Medicamento', 'Cant.', 'Precio Unit.', 'Subtotal']
-                    
-                    st.dataframe(df_carrito_display, use_container_width=True)
+                    # Se muestra el DataFrame de la sesión tal cual, sin copiarlo
+                    st.dataframe(
+                        st.session_state.carrito,
+                        use_container_width=True,
+                        hide_index=True,
+                        column_order=['codigo', 'nombre', 'cantidad', 'precio_unitario', 'subtotal'],
+                        column_config={
+                            'codigo': 'Código',
+                            'nombre': 'Medicamento',
+                            'cantidad': 'Cant.',
+                            'precio_unitario': st.column_config.NumberColumn('Precio Unit.', format="S/ %.2f"),
+                            'subtotal': st.column_config.NumberColumn('Subtotal', format="S/ %.2f"),
+                        }
+                    )
                     
                     # Totales
-                    subtotal_carrito = sum(item['subtotal'] for item in st.session_state.carrito)
+                    subtotal_carrito = st.session_state.carrito_subtotal
                     igv = subtotal_carrito * 0.18
                     total_carrito = subtotal_carrito + igv
                     
@@ -867,7 +1464,8 @@ def main():
                     col_b1, col_b2 = st.columns(2)
                     with col_b1:
                         if st.button("🗑️ Vaciar Carrito"):
-                            st.session_state.carrito = []
+                            st.session_state.carrito = carrito_vacio()
+                            st.session_state.carrito_subtotal = 0.0
                             st.rerun()
                     
                     with col_b2:
@@ -879,26 +1477,26 @@ def main():
                                 st.session_state.cliente_id,
                                 st.session_state.carrito,
                                 st.session_state.cliente_direccion,
-                                observaciones
+                                observaciones,
+                                estado='PROFORMA_GENERADA'
                             )
                             
                             if pedido_id:
                                 st.success(f"✅ Pedido creado: {numero_pedido}")
                                 
-                                # Actualizar estado a PROFORMA_GENERADA
-                                actualizar_estado_pedido(pedido_id, 'PROFORMA_GENERADA')
-                                
-                                # Enviar notificación WhatsApp (simulado)
+                                # Enviar notificación WhatsApp (simulado) sin esperar la respuesta
                                 mensaje = f"Hola {st.session_state.cliente_nombre}, tu proforma #{numero_pedido} ha sido generada. Total: S/ {total:.2f}"
-                                enviar_whatsapp(
-                                    telefono_cliente,
+                                en_segundo_plano(
+                                    enviar_whatsapp,
+                                    st.session_state.cliente_telefono,
                                     mensaje,
                                     'PROFORMA',
                                     pedido_id,
                                     st.session_state.cliente_id
                                 )
                                 
-                                st.session_state.carrito = []
+                                st.session_state.carrito = carrito_vacio()
+                                st.session_state.carrito_subtotal = 0.0
                                 st.balloons()
                                 st.rerun()
             else:
@@ -918,60 +1516,34 @@ def main():
                 ["Todos", "PENDIENTE", "PROFORMA_GENERADA", "CONFIRMADO", "PAGADO", "ENVIADO", "ENTREGADO", "CANCELADO"]
             )
         
-        # Obtener pedidos
-        if filtro_estado == "Todos":
-            query = """
-                SELECT p.*, c.nombre as cliente_nombre, c.telefono
-                FROM pedidos p
-                JOIN clientes c ON p.cliente_id = c.id
-                ORDER BY p.fecha_pedido DESC
-                LIMIT 50
-            """
-            pedidos = db.execute_query(query)
-        else:
-            query = """
-                SELECT p.*, c.nombre as cliente_nombre, c.telefono
-                FROM pedidos p
-                JOIN clientes c ON p.cliente_id = c.id
-                WHERE p.estado = %s
-                ORDER BY p.fecha_pedido DESC
-                LIMIT 50
-            """
-            pedidos = db.execute_query(query, (filtro_estado,))
+        # Paginación: (fecha_pedido, id) del último pedido de cada página visitada
+        if st.session_state.get('pedidos_filtro') != filtro_estado:
+            st.session_state.pedidos_filtro = filtro_estado
+            st.session_state.pedidos_cursores = [None]
+        cursores = st.session_state.pedidos_cursores
+        
+        # Obtener pedidos (una página pequeña: un solo fetch del lado del cliente)
+        pedidos = obtener_pedidos(
+            None if filtro_estado == "Todos" else filtro_estado,
+            cursores[-1]
+        )
         
         if pedidos:
             for pedido in pedidos:
-                with st.expander(f"📦 Pedido {pedido['numero_pedido']} - {pedido['estado']} - S/ {pedido['total']:.2f}"):
-                    col_p1, col_p2 = st.columns([2, 1])
-                    
-                    with col_p1:
-                        st.write(f"**Cliente:** {pedido['cliente_nombre']}")
-                        st.write(f"**Teléfono:** {pedido['telefono']}")
-                        st.write(f"**Fecha:** {pedido['fecha_pedido'].strftime('%d/%m/%Y %H:%M')}")
-                        st.write(f"**Dirección:** {pedido['direccion_envio']}")
-                    
-                    with col_p2:
-                        nuevo_estado = st.selectbox(
-                            "Actualizar estado:",
-                            ["PROFORMA_GENERADA", "CONFIRMADO", "PAGADO", "ENVIADO", "ENTREGADO", "CANCELADO"],
-                            key=f"estado_{pedido['id']}"
-                        )
-                        
-                        if st.button("💾 Actualizar", key=f"btn_{pedido['id']}"):
-                            if actualizar_estado_pedido(pedido['id'], nuevo_estado):
-                                st.success("✅ Estado actualizado")
-                                
-                                if nuevo_estado == 'PAGADO':
-                                    # Generar voucher
-                                    voucher_pdf = generar_voucher_pdf(pedido['id'])
-                                    st.download_button(
-                                        label="📄 Descargar Voucher",
-                                        data=voucher_pdf,
-                                        file_name=f"voucher_{pedido['numero_pedido']}.pdf",
-                                        mime="application/pdf"
-                                    )
-                                
-                                st.rerun()
+                mostrar_pedido(pedido)
+            
+            col_n1, col_n2, col_n3 = st.columns([1, 2, 1])
+            with col_n1:
+                if len(cursores) > 1 and st.button("◀ Anterior"):
+                    cursores.pop()
+                    st.rerun()
+            with col_n2:
+                st.caption(f"Página {len(cursores)}")
+            with col_n3:
+                if len(pedidos) == PEDIDOS_POR_PAGINA and st.button("Siguiente ▶"):
+                    ultimo = pedidos[-1]
+                    cursores.append((ultimo['fecha_pedido'], ultimo['id']))
+                    st.rerun()
         else:
             st.info("No hay pedidos disponibles")
     
@@ -981,19 +1553,25 @@ def main():
     elif menu_option == "👥 Clientes":
         st.header("Gestión de Clientes")
         
-        query = """
-            SELECT * FROM clientes 
-            ORDER BY fecha_registro DESC
-            LIMIT 100
-        """
-        clientes = db.execute_query(query)
+        busqueda_cliente = st.text_input("🔍 Buscar cliente", placeholder="Nombre o teléfono")
+        clientes = obtener_clientes(busqueda_cliente or None)
         
         if clientes:
-            df_clientes = pd.DataFrame(clientes)
-            st.dataframe(df_clientes[[
-                'nombre', 'telefono', 'email', 'distrito', 
-                'total_compras', 'monto_total_gastado', 'ultima_compra'
-            ]], use_container_width=True)
+            # La consulta ya trae solo las columnas mostradas
+            df_clientes = (
+                pd.DataFrame(clientes)
+                .astype({'monto_total_gastado': 'float64'})
+                .convert_dtypes(dtype_backend='pyarrow')
+            )
+            st.dataframe(
+                df_clientes,
+                use_container_width=True,
+                hide_index=True,
+                column_config={
+                    'monto_total_gastado': st.column_config.NumberColumn('Monto Gastado', format="S/ %.2f"),
+                    'ultima_compra': st.column_config.DatetimeColumn('Última Compra', format='DD/MM/YYYY HH:mm')
+                }
+            )
         else:
             st.info("No hay clientes registrados")
     
@@ -1006,29 +1584,47 @@ def main():
         tab1, tab2 = st.tabs(["📋 Catálogo", "➕ Agregar Medicamento"])
         
         with tab1:
-            df_meds = obtener_medicamentos_disponibles()
+            # Filtros (se aplican en la consulta SQL)
+            try:
+                categorias = obtener_categorias()
+            except psycopg2.Error:
+                categorias = CATEGORIAS_MEDICAMENTOS
+            
+            col_f1, col_f2, col_f3 = st.columns([2, 2, 1])
+            with col_f1:
+                categoria_filtro = st.selectbox("Filtrar por categoría:", ['Todos'] + categorias)
+            with col_f2:
+                busqueda_catalogo = st.text_input("Buscar por nombre o código:")
+            with col_f3:
+                pagina = st.number_input("Página", min_value=1, value=1, step=1)
+            
+            try:
+                df_meds = obtener_medicamentos_disponibles(
+                    categoria=None if categoria_filtro == 'Todos' else categoria_filtro,
+                    busqueda=busqueda_catalogo or None,
+                    limite=MEDICAMENTOS_POR_PAGINA,
+                    offset=(pagina - 1) * MEDICAMENTOS_POR_PAGINA
+                )
+            except psycopg2.Error:
+                df_meds = pd.DataFrame()
             
             if not df_meds.empty:
-                # Filtro por categoría
-                categorias = ['Todos'] + df_meds['categoria'].unique().tolist()
-                categoria_filtro = st.selectbox("Filtrar por categoría:", categorias)
-                
-                if categoria_filtro != 'Todos':
-                    df_meds = df_meds[df_meds['categoria'] == categoria_filtro]
-                
                 # Mostrar medicamentos
                 st.dataframe(df_meds[[
                     'codigo', 'nombre', 'categoria', 'laboratorio',
                     'precio_unitario', 'stock', 'stock_minimo'
                 ]], use_container_width=True)
-                
-                # Medicamentos con stock bajo
-                stock_bajo_df = df_meds[df_meds['stock'] <= df_meds['stock_minimo']]
-                if not stock_bajo_df.empty:
-                    st.warning("⚠️ Medicamentos con Stock Bajo")
-                    st.dataframe(stock_bajo_df[['codigo', 'nombre', 'stock', 'stock_minimo']])
             else:
                 st.info("No hay medicamentos en el catálogo")
+            
+            # Medicamentos con stock bajo (todo el catálogo, no solo la página actual)
+            try:
+                stock_bajo_df = obtener_medicamentos_stock_bajo()
+            except psycopg2.Error:
+                stock_bajo_df = pd.DataFrame()
+            if not stock_bajo_df.empty:
+                st.warning("⚠️ Medicamentos con Stock Bajo")
+                st.dataframe(stock_bajo_df, use_container_width=True, hide_index=True)
         
         with tab2:
             st.subheader("Agregar Nuevo Medicamento")
@@ -1048,8 +1644,7 @@ def main():
                 nuevo_stock = st.number_input("Stock Inicial*", min_value=0, step=1)
                 nueva_categoria = st.selectbox(
                     "Categoría*",
-                    ["Analgésicos", "Antibióticos", "Vitaminas", "Cardiovascular", 
-                     "Gastroenterología", "Alergias", "Diabetes", "Respiratorio", "Otros"]
+                    CATEGORIAS_MEDICAMENTOS
                 )
                 requiere_receta = st.checkbox("Requiere Receta")
             
@@ -1074,6 +1669,10 @@ def main():
                     
                     med_id = db.execute_insert(query, params)
                     if med_id:
+                        obtener_medicamentos_disponibles.clear()
+                        obtener_medicamentos_stock_bajo.clear()
+                        obtener_categorias.clear()
+                        obtener_metricas_dashboard.clear()
                         st.success(f"✅ Medicamento agregado exitosamente (ID: {med_id})")
                         st.balloons()
                     else:
@@ -1099,20 +1698,15 @@ def main():
                 fecha_fin = st.date_input("Fecha Fin", value=datetime.now())
             
             if st.button("🔍 Generar Reporte"):
+                st.session_state.reporte_ventas_rango = (fecha_inicio, fecha_fin)
+            
+            # El reporte se mantiene visible entre reruns mientras no cambien las fechas
+            if st.session_state.get('reporte_ventas_rango') == (fecha_inicio, fecha_fin):
                 # Obtener datos
-                query = """
-                    SELECT 
-                        DATE(fecha_pedido) as fecha,
-                        COUNT(*) as total_pedidos,
-                        SUM(total) as monto_total,
-                        AVG(total) as ticket_promedio
-                    FROM pedidos
-                    WHERE estado IN ('PAGADO', 'ENVIADO', 'ENTREGADO')
-                    AND fecha_pedido BETWEEN %s AND %s
-                    GROUP BY DATE(fecha_pedido)
-                    ORDER BY fecha
-                """
-                ventas = db.execute_query(query, (fecha_inicio, fecha_fin))
+                try:
+                    ventas = obtener_reporte_ventas(fecha_inicio, fecha_fin)
+                except psycopg2.Error:
+                    ventas = None
                 
                 if ventas:
                     df_ventas_reporte = pd.DataFrame(ventas)
@@ -1130,38 +1724,66 @@ def main():
                     with col_m3:
                         st.metric("Ticket Promedio", f"S/ {ticket_promedio:.2f}")
                     
-                    # Gráfico de ventas
-                    fig = px.bar(
-                        df_ventas_reporte,
-                        x='fecha',
-                        y='monto_total',
-                        title='Ventas por Día',
-                        labels={'fecha': 'Fecha', 'monto_total': 'Monto Total (S/)'}
+                    # Gráfico de ventas (agrupado por semana/mes en rangos largos)
+                    df_grafico, periodo = reagrupar_ventas_para_grafico(
+                        df_ventas_reporte, 'fecha', 'monto_total'
+                    )
+                    fig = go.Figure(go.Bar(x=df_grafico['fecha'], y=df_grafico['monto_total']))
+                    fig.update_layout(
+                        title=f'Ventas por {periodo}',
+                        xaxis_title='Fecha',
+                        yaxis_title='Monto Total (S/)',
+                        uirevision='reporte_ventas'
                     )
                     st.plotly_chart(fig, use_container_width=True)
                     
                     # Tabla de datos
                     st.dataframe(df_ventas_reporte, use_container_width=True)
                     
-                    # Botón de descarga PDF
-                    pdf_ventas = generar_reporte_ventas_pdf(fecha_inicio, fecha_fin)
-                    st.download_button(
-                        label="📄 Descargar Reporte PDF",
-                        data=pdf_ventas,
-                        file_name=f"reporte_ventas_{fecha_inicio}_{fecha_fin}.pdf",
-                        mime="application/pdf"
-                    )
+                    # El PDF solo se genera si se solicita
+                    if st.button("📄 Preparar Reporte PDF"):
+                        try:
+                            st.download_button(
+                                label="⬇️ Descargar Reporte PDF",
+                                data=obtener_reporte_ventas_pdf(fecha_inicio, fecha_fin),
+                                file_name=f"reporte_ventas_{fecha_inicio}_{fecha_fin}.pdf",
+                                mime="application/pdf"
+                            )
+                        except psycopg2.Error as e:
+                            st.error(f"Error al generar el reporte PDF: {str(e)}")
                 else:
                     st.info("No hay datos para el período seleccionado")
         
         with tab2:
             st.subheader("Reporte de Productos")
             
+            query_historial = """
+                SELECT 
+                    h.fecha,
+                    m.nombre as medicamento,
+                    h.tipo_movimiento,
+                    h.cantidad,
+                    h.stock_anterior,
+                    h.stock_nuevo,
+                    h.observaciones
+                FROM historial_stock h
+                JOIN medicamentos m ON h.medicamento_id = m.id
+                ORDER BY h.fecha DESC
+                LIMIT 50
+            """
+            try:
+                df_top_productos, df_cat, historial = cargar_en_paralelo(
+                    (obtener_productos_mas_vendidos, 15),
+                    (obtener_ventas_por_categoria,),
+                    (db.execute_query, query_historial)
+                )
+            except psycopg2.Error:
+                df_top_productos, df_cat, historial = pd.DataFrame(), pd.DataFrame(), None
+            
             col_p1, col_p2 = st.columns(2)
             
             with col_p1:
                 st.write("**Top 15 Productos Más Vendidos**")
-                df_top_productos = obtener_productos_mas_vendidos(15)
                 if not df_top_productos.empty:
                     fig_productos = px.bar(
                         df_top_productos,
@@ -1178,14 +1800,8 @@ def main():
             
             with col_p2:
                 st.write("**Ventas por Categoría**")
-                df_cat = obtener_ventas_por_categoria()
                 if not df_cat.empty:
-                    fig_cat = px.pie(
-                        df_cat,
-                        values='ingresos',
-                        names='categoria',
-                        title='Distribución de Ingresos'
-                    )
+                    fig_cat = grafico_ventas_categoria(df_cat, 'Distribución de Ingresos', 'reporte_categorias')
                     st.plotly_chart(fig_cat, use_container_width=True)
                     st.dataframe(df_cat, use_container_width=True)
                 else:
@@ -1194,24 +1810,16 @@ def main():
             # Historial de movimientos de stock
             st.markdown("---")
             st.write("**Historial de Movimientos de Stock (Últimos 50)**")
-            query_historial = """
-                SELECT 
-                    h.fecha,
-                    m.nombre as medicamento,
-                    h.tipo_movimiento,
-                    h.cantidad,
-                    h.stock_anterior,
-                    h.stock_nuevo,
-                    h.observaciones
-                FROM historial_stock h
-                JOIN medicamentos m ON h.medicamento_id = m.id
-                ORDER BY h.fecha DESC
-                LIMIT 50
-            """
-            historial = db.execute_query(query_historial)
             if historial:
-                df_historial = pd.DataFrame(historial)
-                st.dataframe(df_historial, use_container_width=True)
+                df_historial = pd.DataFrame(historial).convert_dtypes(dtype_backend='pyarrow')
+                st.dataframe(
+                    df_historial,
+                    use_container_width=True,
+                    hide_index=True,
+                    column_config={
+                        'fecha': st.column_config.DatetimeColumn('Fecha', format='DD/MM/YYYY HH:mm')
+                    }
+                )
             else:
                 st.info("No hay movimientos registrados")
         
@@ -1226,52 +1834,61 @@ def main():
                     total_compras,
                     monto_total_gastado,
                     ultima_compra,
-                    CASE 
-                        WHEN total_compras >= 10 THEN 'VIP'
-                        WHEN total_compras >= 5 THEN 'Frecuente'
-                        ELSE 'Regular'
-                    END as categoria
+                    categoria_cliente as categoria
                 FROM clientes
                 WHERE total_compras > 0
                 ORDER BY monto_total_gastado DESC
                 LIMIT 20
             """
-            top_clientes = db.execute_query(query_top_clientes)
+            try:
+                top_clientes, estadisticas = cargar_en_paralelo(
+                    (db.execute_query, query_top_clientes),
+                    (obtener_estadisticas_clientes,)
+                )
+            except psycopg2.Error:
+                top_clientes, estadisticas = None, None
             
-            if top_clientes:
-                df_top_clientes = pd.DataFrame(top_clientes)
+            if top_clientes and estadisticas:
+                df_top_clientes = (
+                    pd.DataFrame(top_clientes)
+                    .astype({'monto_total_gastado': 'float64'})
+                    .convert_dtypes(dtype_backend='pyarrow')
+                )
                 
                 col_c1, col_c2 = st.columns(2)
                 
                 with col_c1:
                     st.write("**Top 20 Clientes por Monto**")
-                    st.dataframe(df_top_clientes, use_container_width=True)
+                    st.dataframe(
+                        df_top_clientes,
+                        use_container_width=True,
+                        hide_index=True,
+                        column_config={
+                            'monto_total_gastado': st.column_config.NumberColumn('Monto Gastado', format="S/ %.2f"),
+                            'ultima_compra': st.column_config.DatetimeColumn('Última Compra', format='DD/MM/YYYY HH:mm')
+                        }
+                    )
                 
                 with col_c2:
                     st.write("**Distribución de Clientes por Categoría**")
-                    categoria_count = df_top_clientes['categoria'].value_counts()
                     fig_clientes = px.pie(
-                        values=categoria_count.values,
-                        names=categoria_count.index,
+                        values=[estadisticas['vip'], estadisticas['frecuente'], estadisticas['regular']],
+                        names=['VIP', 'Frecuente', 'Regular'],
                         title='Categorías de Clientes'
                     )
                     st.plotly_chart(fig_clientes, use_container_width=True)
                 
-                # Estadísticas generales
+                # Estadísticas generales (sobre todos los clientes, no solo el top 20)
                 st.markdown("---")
                 st.write("**Estadísticas Generales de Clientes**")
                 
-                total_clientes_activos = len(df_top_clientes)
-                promedio_compras = df_top_clientes['total_compras'].mean()
-                promedio_gastado = df_top_clientes['monto_total_gastado'].mean()
-                
                 col_e1, col_e2, col_e3 = st.columns(3)
                 with col_e1:
-                    st.metric("Clientes Activos", total_clientes_activos)
+                    st.metric("Clientes Activos", estadisticas['activos'])
                 with col_e2:
-                    st.metric("Promedio Compras", f"{promedio_compras:.1f}")
+                    st.metric("Promedio Compras", f"{estadisticas['promedio_compras']:.1f}")
                 with col_e3:
-                    st.metric("Promedio Gastado", f"S/ {promedio_gastado:.2f}")
+                    st.metric("Promedio Gastado", f"S/ {estadisticas['promedio_gastado']:.2f}")
             else:
                 st.info("No hay datos de clientes disponibles")
 
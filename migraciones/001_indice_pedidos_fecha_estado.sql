@@ -0,0 +1,5 @@
+-- Índice parcial para las ventas confirmadas filtradas por fecha
+-- (métricas del dashboard y reportes de ventas)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_pedidos_fecha_estado
+    ON pedidos (fecha_pedido)
+    WHERE estado IN ('PAGADO', 'ENVIADO', 'ENTREGADO');
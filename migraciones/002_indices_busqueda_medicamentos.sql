@@ -0,0 +1,13 @@
+-- Búsqueda por subcadena (ILIKE '%texto%') en el catálogo de medicamentos
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_medicamentos_nombre_trgm
+    ON medicamentos USING gin (nombre gin_trgm_ops);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_medicamentos_codigo_trgm
+    ON medicamentos USING gin (codigo gin_trgm_ops);
+
+-- Listado paginado del catálogo (ORDER BY categoria, nombre)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_medicamentos_disponibles
+    ON medicamentos (categoria, nombre)
+    WHERE activo = TRUE AND stock > 0;
@@ -0,0 +1,44 @@
+-- Índices para las consultas de Gestión de Pedidos, Reportes y Clientes.
+-- Verificar con EXPLAIN ANALYZE que el listado de pedidos usa un Index Scan:
+-- (misma consulta que obtener_pedidos, segunda página con filtro de estado)
+--   EXPLAIN ANALYZE
+--   SELECT p.id, p.numero_pedido, p.estado, p.total,
+--          p.fecha_pedido, p.direccion_envio,
+--          c.nombre AS cliente_nombre, c.telefono
+--   FROM pedidos p
+--   JOIN clientes c ON p.cliente_id = c.id
+--   WHERE p.estado = 'PAGADO'
+--   AND (p.fecha_pedido, p.id) < ('2024-06-01 12:00', 1000)
+--   ORDER BY p.fecha_pedido DESC, p.id DESC
+--   LIMIT 20;
+-- Debe aparecer idx_pedidos_estado_fecha_id sin un nodo Sort.
+
+-- Gestión de Pedidos filtrada por estado, más recientes primero.
+-- Incluyen id para la paginación por keyset:
+--   ORDER BY fecha_pedido DESC, id DESC  con  (fecha_pedido, id) < (%s, %s)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_pedidos_estado_fecha_id
+    ON pedidos (estado, fecha_pedido DESC, id DESC);
+
+-- Gestión de Pedidos sin filtro y rangos de fechas de Reportes
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_pedidos_fecha_id
+    ON pedidos (fecha_pedido DESC, id DESC);
+
+-- JOIN pedidos -> clientes
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_pedidos_cliente
+    ON pedidos (cliente_id);
+
+-- Voucher y agregados de productos vendidos
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_detalle_pedidos_pedido
+    ON detalle_pedidos (pedido_id, medicamento_id);
+
+-- Historial de movimientos de stock (últimos 50)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_historial_stock_fecha
+    ON historial_stock (fecha DESC);
+
+-- verificar_cliente_existente
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_clientes_telefono
+    ON clientes (telefono);
+
+-- Listado de clientes (más recientes primero)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_clientes_fecha_registro
+    ON clientes (fecha_registro DESC);
@@ -0,0 +1,8 @@
+-- Búsqueda de clientes por subcadena (ILIKE '%texto%')
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_clientes_nombre_trgm
+    ON clientes USING gin (nombre gin_trgm_ops);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_clientes_telefono_trgm
+    ON clientes USING gin (telefono gin_trgm_ops);
@@ -0,0 +1,14 @@
+-- Categoría de cliente calculada por la base de datos al escribir la fila,
+-- en lugar del CASE del Reporte de Clientes en cada ejecución.
+-- Requiere PostgreSQL 12+ (columnas generadas); reescribe la tabla clientes.
+-- DDL transaccional: puede ejecutarse dentro de una transacción. Sus índices
+-- están en 006, que usa CONCURRENTLY y debe ejecutarse aparte.
+ALTER TABLE clientes
+    ADD COLUMN IF NOT EXISTS categoria_cliente TEXT
+    GENERATED ALWAYS AS (
+        CASE
+            WHEN total_compras >= 10 THEN 'VIP'
+            WHEN total_compras >= 5 THEN 'Frecuente'
+            ELSE 'Regular'
+        END
+    ) STORED;
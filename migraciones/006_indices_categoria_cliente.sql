@@ -0,0 +1,9 @@
+-- Índices sobre la columna categoria_cliente de 005 (ejecutar después de 005).
+-- CREATE INDEX CONCURRENTLY no admite transacciones: ver README.md.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_clientes_categoria
+    ON clientes (categoria_cliente);
+
+-- Top de clientes: WHERE total_compras > 0 ORDER BY monto_total_gastado DESC LIMIT 20
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_clientes_monto_activos
+    ON clientes (monto_total_gastado DESC)
+    WHERE total_compras > 0;